@@ -0,0 +1,134 @@
+import json
+import queue
+import threading
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # orjson là tùy chọn, không có thì dùng json chuẩn
+    orjson = None
+
+
+WRITE_BATCH_SIZE = 4096
+WRITE_QUEUE_SIZE = 16
+SHARD_BUFFER_SIZE = 1 << 20
+
+
+def encode_jsonl_line(rec: dict) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(rec, option=orjson.OPT_APPEND_NEWLINE)
+        except TypeError:
+            # chuỗi chứa surrogate (vd. tên file không phải UTF-8): orjson từ chối,
+            # dùng nhánh json bên dưới để thay bằng "?" như trước
+            pass
+    line = json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n"
+    return line.encode("utf-8", errors="replace")
+
+
+# Bộ mã hóa chuỗi JSON (bản C) mà json.dumps(ensure_ascii=False) dùng bên trong
+_encode_json_str = json.encoder.encode_basestring
+
+
+def encode_doc_record(title: str, summary: str) -> bytes:
+    # Bản ghi doc luôn chỉ có title và summary (đều là str) nên nhận thẳng hai chuỗi,
+    # không cần dict trung gian; không có orjson thì ghép theo mẫu cố định.
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                {"title": title, "summary": summary}, option=orjson.OPT_APPEND_NEWLINE
+            )
+        except TypeError:
+            # surrogate trong title/summary: để nhánh mẫu cố định thay bằng "?"
+            pass
+    line = '{"title":' + _encode_json_str(title) + ',"summary":' + _encode_json_str(summary) + "}\n"
+    return line.encode("utf-8", errors="replace")
+
+
+def write_sharded_jsonl(
+    lines: Iterable[bytes],
+    output_dir: Path,
+    prefix: str,
+    max_records_per_file: int,
+) -> int:
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Luồng chính sinh và mã hóa bản ghi; một luồng nền ghi từng lô xuống đĩa
+    # để việc phân tích không phải chờ I/O. Hàng đợi có giới hạn để chặn bộ nhớ.
+    chunks: "queue.Queue[Optional[Tuple[int, List[bytes]]]]" = queue.Queue(
+        maxsize=WRITE_QUEUE_SIZE
+    )
+    errors: List[BaseException] = []
+
+    def open_new_shard(idx: int):
+        filename = f"{prefix}_{idx:05d}.jsonl"
+        return (output_dir / filename).open("wb", buffering=SHARD_BUFFER_SIZE)
+
+    def write_chunks() -> None:
+        current_index = 1
+        file_handle = None
+        finished = False
+        try:
+            file_handle = open_new_shard(current_index)
+            while True:
+                item = chunks.get()
+                if item is None:
+                    finished = True
+                    break
+                idx, batch = item
+                if idx != current_index:
+                    file_handle.close()
+                    current_index = idx
+                    file_handle = open_new_shard(current_index)
+                file_handle.write(b"".join(batch))
+            # close() flush phần cuối của shard nên phải nằm trong try để lỗi (vd. hết dung
+            # lượng) được ghi nhận vào errors
+            file_handle.close()
+        except BaseException as exc:  # noqa: BLE001
+            errors.append(exc)
+            if file_handle is not None and not file_handle.closed:
+                try:
+                    file_handle.close()
+                except OSError:
+                    pass
+            # tiếp tục rút hàng đợi (nếu chưa gặp None) để luồng chính không bị chặn ở put()
+            if not finished:
+                while chunks.get() is not None:
+                    pass
+
+    shard_index = 1
+    record_in_shard = 0
+    written_total = 0
+    batch: List[bytes] = []
+
+    writer = threading.Thread(target=write_chunks, name="jsonl-writer", daemon=True)
+    writer.start()
+    try:
+        for line in lines:
+            if max_records_per_file > 0 and record_in_shard >= max_records_per_file:
+                if batch:
+                    chunks.put((shard_index, batch))
+                    batch = []
+                shard_index += 1
+                record_in_shard = 0
+
+            batch.append(line)
+            record_in_shard += 1
+            written_total += 1
+            if len(batch) >= WRITE_BATCH_SIZE:
+                chunks.put((shard_index, batch))
+                batch = []
+                if errors:
+                    break
+    finally:
+        # gửi nốt lô còn dở, kể cả khi nguồn bản ghi ném lỗi giữa chừng, để những bản ghi
+        # đã sinh ra vẫn được ghi như khi ghi trực tiếp từng dòng
+        if batch and not errors:
+            chunks.put((shard_index, batch))
+        chunks.put(None)
+        writer.join()
+
+    if errors:
+        raise errors[0]
+    return written_total
@@ -5,6 +5,8 @@ from pathlib import Path
 from typing import Generator, Iterable, List, Optional
 import re
 
+from ._core import encode_jsonl_line, write_sharded_jsonl
+
 
 def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(
@@ -78,6 +80,11 @@ def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
     return parser.parse_args(argv)
 
 
+# Lọc bỏ các ký tự không phải tiếng Việt và các ký tự đặc biệt không mong muốn
+UNWANTED_CHARS_RE = re.compile(r'[^\w\s.,?!:;()"\'\u00C0-\u1FFF]+')
+SENTENCE_SPLIT_RE = re.compile(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?|!)\s')
+
+
 def collect_txt_files(input_dirs: Iterable[str], recursive: bool = True) -> List[Path]:
     collected: List[Path] = []
     for directory in input_dirs:
@@ -94,8 +101,12 @@ def collect_txt_files(input_dirs: Iterable[str], recursive: bool = True) -> List
             for path in base.iterdir():
                 if path.is_file() and path.name.lower().endswith(".txt"):
                     collected.append(path)
-    collected = sorted(set(p.resolve() for p in collected))
-    return collected
+    # Khử trùng lặp theo chuỗi đường dẫn (giữ thứ tự, không stat/readlink từng file);
+    # chỉ sắp xếp chuỗi một lần để thứ tự bản ghi ổn định giữa các lần chạy.
+    seen = {}
+    for p in collected:
+        seen.setdefault(os.fspath(p), p)
+    return [seen[key] for key in sorted(seen)]
 
 
 def read_first_n_chars(file_path: Path, limit: int) -> str:
@@ -124,10 +135,9 @@ def read_file_chunks(file_path: Path, chunk_size: int, overlap: int) -> List[str
     if not content:
         return []
     
-    # Lọc bỏ các ký tự không phải tiếng Việt và các ký tự đặc biệt không mong muốn
-    content = re.sub(r'[^\w\s.,?!:;()"\'\u00C0-\u1FFF]+', '', content)
+    content = UNWANTED_CHARS_RE.sub('', content)
     
-    sentences = re.split(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?|!)\s', content)
+    sentences = SENTENCE_SPLIT_RE.split(content)
     
     chunks = []
     current_chunk = ""
@@ -236,41 +246,6 @@ def ensure_output_dir(path: str) -> Path:
     return out
 
 
-def write_sharded_jsonl(
-    records: Iterable[dict],
-    output_dir: Path,
-    prefix: str,
-    max_records_per_file: int,
-) -> int:
-    shard_index = 1
-    record_in_shard = 0
-    file_handle = None
-    written_total = 0
-
-    def open_new_shard(idx: int):
-        filename = f"{prefix}_{idx:05d}.jsonl"
-        return (output_dir / filename).open("w", encoding="utf-8", errors="replace")
-
-    try:
-        file_handle = open_new_shard(shard_index)
-        for rec in records:
-            if max_records_per_file > 0 and record_in_shard >= max_records_per_file:
-                file_handle.close()
-                shard_index += 1
-                record_in_shard = 0
-                file_handle = open_new_shard(shard_index)
-
-            json_line = json.dumps(rec, ensure_ascii=False)
-            file_handle.write(json_line + "\n")
-            record_in_shard += 1
-            written_total += 1
-    finally:
-        if file_handle is not None and not file_handle.closed:
-            file_handle.close()
-
-    return written_total
-
-
 def run(argv: Optional[List[str]] = None) -> None:
     args = parse_args(argv)
 
@@ -293,16 +268,17 @@ def run(argv: Optional[List[str]] = None) -> None:
         return
 
     output_dir = ensure_output_dir(args.output_dir)
+    records = generate_records(
+        files,
+        input_dirs=args.input_dirs,
+        summary_chars=args.summary_chars,
+        title_source=args.title_source,
+        title_max_chars=args.title_max_chars,
+        split_mode=args.split_mode,
+        chunk_overlap=args.chunk_overlap,
+    )
     total = write_sharded_jsonl(
-        generate_records(
-            files,
-            input_dirs=args.input_dirs,
-            summary_chars=args.summary_chars,
-            title_source=args.title_source,
-            title_max_chars=args.title_max_chars,
-            split_mode=args.split_mode,
-            chunk_overlap=args.chunk_overlap,
-        ),
+        (encode_jsonl_line(rec) for rec in records),
         output_dir=output_dir,
         prefix=args.prefix,
         max_records_per_file=args.max_records_per_file,
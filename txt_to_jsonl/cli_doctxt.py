@@ -1,10 +1,20 @@
 import argparse
+import fnmatch
+import io
 import json
+import mmap
 import os
-import re
-import fnmatch
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
 from pathlib import Path
-from typing import Generator, Iterable, List, Optional, Tuple
+from typing import BinaryIO, Deque, Generator, Iterator, List, Optional, Tuple, Union
+
+from ._core import encode_doc_record, write_sharded_jsonl
+
+
+# số file gửi cho tiến trình con trong mỗi lần submit khi chạy song song
+FILES_PER_TASK = 8
 
 
 def parse_args() -> argparse.Namespace:
@@ -63,6 +73,12 @@ def parse_args() -> argparse.Namespace:
         default=120,
         help="Giới hạn ký tự cho title trích từ tag (mặc định: 120).",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Số tiến trình xử lý song song các file (mặc định: 0 = số CPU; 1 = chạy tuần tự).",
+    )
     parser.add_argument(
         "--dry-run",
         action="store_true",
@@ -71,149 +87,376 @@ def parse_args() -> argparse.Namespace:
     return parser.parse_args()
 
 
-DOC_TITLE_RE = re.compile(r'title="(.*?)"')
+def extract_title_from_opening_tag(tag: bytes) -> Optional[str]:
+    # title="..." có dạng cố định nên tìm trực tiếp, chỉ giải mã phần giá trị
+    i = tag.find(b'title="')
+    if i < 0:
+        return None
+    j = tag.find(b'"', i + 7)
+    if j < 0:
+        return None
+    return tag[i + 7 : j].decode("utf-8", errors="replace")
 
 
-def extract_title_from_opening_tag(line: str) -> Optional[str]:
-    match = DOC_TITLE_RE.search(line)
-    return match.group(1) if match else None
+def _decode_text(data: Union[bytes, bytearray, memoryview]) -> str:
+    # str(...) giải mã thẳng từ buffer, không cần tạo bản sao bytes
+    text = str(data, "utf-8", "replace")
+    if "\r" in text:
+        # giữ hành vi universal newlines như khi đọc file ở chế độ text
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
 
 
-def iter_doc_blocks(file_path: Path) -> Generator[Tuple[Optional[str], str], None, None]:
+def _summary_from_bytes(
+    data: Union[bytes, bytearray, memoryview], summary_chars: int
+) -> str:
+    if summary_chars <= 0:
+        return ""
+    return _decode_text(data)[:summary_chars]
+
+
+# Universal newlines coi cả "\n", "\r\n" và "\r" đơn lẻ là xuống dòng. Hai hàm dưới tìm
+# ký tự xuống dòng đầu/cuối trong [start, end); "\r" chỉ được tìm trong đoạn đã giới hạn
+# bởi "\n" gần nhất để không phải quét cả phần còn lại của file khi không có "\r".
+def _find_line_break(data: Union[bytes, bytearray, mmap.mmap], start: int, end: int) -> int:
+    k = data.find(b"\n", start, end)
+    r = data.find(b"\r", start, end if k < 0 else k)
+    return r if r >= 0 else k
+
+
+def _rfind_line_break(data: Union[bytes, bytearray, mmap.mmap], start: int, end: int) -> int:
+    k = data.rfind(b"\n", start, end)
+    r = data.rfind(b"\r", k + 1 if k >= 0 else start, end)
+    return r if r >= 0 else k
+
+
+def _after_line_break(data: Union[bytes, bytearray, mmap.mmap], pos: int) -> int:
+    # vị trí đầu dòng kế tiếp, tính cả cặp "\r\n"
+    if data[pos : pos + 2] == b"\r\n":
+        return pos + 2
+    return pos + 1
+
+
+def _iter_doc_blocks_stream(
+    f: BinaryIO, summary_chars: int
+) -> Generator[Tuple[Optional[str], str], None, None]:
+    # Dùng khi không mmap được (file rỗng, pipe, hệ thống file mạng...): đọc từng dòng ở
+    # chế độ text như cách cũ, chỉ giữ lại các dòng đầu đủ cho summary_chars ký tự.
     inside = False
     buffer: List[str] = []
+    buffered_len = 0
     title_in_tag: Optional[str] = None
 
-    with file_path.open("r", encoding="utf-8", errors="replace") as f:
-        for line in f:
+    # bọc lại chính handle đã mở để không mất dữ liệu đã đọc từ pipe/FIFO
+    with io.TextIOWrapper(f, encoding="utf-8", errors="replace") as text:
+        for line in text:
             if not inside:
                 if "<doc" in line:
                     inside = True
                     buffer.clear()
-                    title_in_tag = extract_title_from_opening_tag(line)
+                    buffered_len = 0
+                    title_in_tag = extract_title_from_opening_tag(line.encode("utf-8"))
                 continue
-            else:
-                if "</doc>" in line:
-                    content = "".join(buffer)
-                    yield (title_in_tag, content)
-                    buffer.clear()
-                    inside = False
-                    title_in_tag = None
-                else:
-                    buffer.append(line)
+            if "</doc>" in line:
+                yield (title_in_tag, "".join(buffer)[:summary_chars] if summary_chars > 0 else "")
+                buffer.clear()
+                inside = False
+                title_in_tag = None
+            elif buffered_len < summary_chars:
+                buffer.append(line)
+                buffered_len += len(line)
+
+
+def _iter_doc_summaries(
+    mm: mmap.mmap, view: memoryview, summary_chars: int
+) -> Generator[Tuple[Optional[str], str], None, None]:
+    # Chỉ giải mã tối đa summary_chars * 4 byte đầu của thân doc (UTF-8 tối đa 4 byte/ký tự),
+    # phần còn lại đến </doc> bị bỏ qua. File không có "\r" nên chỉ cần tìm "\n"; các bước
+    # được viết thẳng trong vòng lặp vì đây là đường nóng với corpus nhiều doc ngắn, và
+    # trường hợp thường gặp (</doc> đứng riêng một dòng) chỉ cần đọc một byte thay vì find.
+    limit = summary_chars * 4
+    size = len(mm)
+    find = mm.find
+    rfind = mm.rfind
+    pos = 0
+    while True:
+        start = find(b"<doc", pos)
+        if start < 0:
+            break
+        nl = find(b"\n", start)
+        if nl < 0:
+            break
+        end = find(b"</doc>", nl)
+        if end < 0:
+            break
+        # Bỏ cả dòng chứa </doc>, giống cách đọc theo dòng. Chỉ cần biết dòng đó bắt đầu
+        # trước hay sau mốc cap, nên không quét ngược cả dòng </doc> khi nó rất dài.
+        body_start = nl + 1
+        cap = body_start + limit
+        if end <= cap:
+            body_end = end if mm[end - 1] == 10 else rfind(b"\n", nl, end) + 1
+        elif find(b"\n", cap, end) >= 0:
+            body_end = cap
+        else:
+            body_end = rfind(b"\n", nl, cap) + 1
+        # title="..." ngay trên dòng mở tag, chỉ giải mã phần giá trị
+        i = find(b'title="', start, nl)
+        title_in_tag = None
+        if i >= 0:
+            j = find(b'"', i + 7, nl)
+            if j >= 0:
+                title_in_tag = mm[i + 7 : j].decode("utf-8", errors="replace")
+        # với thân doc ngắn, cắt bytes rồi decode nhanh hơn tạo memoryview cho mỗi doc
+        summary = mm[body_start:body_end].decode("utf-8", errors="replace")
+        yield (title_in_tag, summary[:summary_chars])
+        # phần còn lại của dòng </doc> không được quét tìm <doc
+        pos = end + 6
+        if pos >= size:
+            break
+        if mm[pos] != 10:
+            pos = find(b"\n", pos)
+            if pos < 0:
+                break
 
 
-def read_first_n_chars(text: str, limit: int) -> str:
-    if limit <= 0:
-        return ""
-    return text[:limit]
+def _iter_doc_titles(mm: mmap.mmap) -> Generator[Tuple[Optional[str], str], None, None]:
+    # summary_chars <= 0: chỉ cần title, không tìm đầu dòng </doc> và không giải mã thân doc
+    find = mm.find
+    pos = 0
+    while True:
+        start = find(b"<doc", pos)
+        if start < 0:
+            break
+        nl = find(b"\n", start)
+        if nl < 0:
+            break
+        end = find(b"</doc>", nl)
+        if end < 0:
+            break
+        yield (extract_title_from_opening_tag(mm[start:nl]), "")
+        pos = find(b"\n", end + 6)
+        if pos < 0:
+            break
+
+
+def _iter_doc_summaries_cr(
+    mm: mmap.mmap, view: memoryview, summary_chars: int
+) -> Generator[Tuple[Optional[str], str], None, None]:
+    # Bản cho file có "\r": xuống dòng có thể là "\n", "\r\n" hoặc "\r" đơn lẻ.
+    limit = summary_chars * 4
+    size = len(mm)
+    pos = 0
+    while True:
+        start = mm.find(b"<doc", pos)
+        if start < 0:
+            break
+        nl = _find_line_break(mm, start, size)
+        if nl < 0:
+            break
+        body_start = _after_line_break(mm, nl)
+        end = mm.find(b"</doc>", body_start)
+        if end < 0:
+            break
+        # Bỏ cả dòng chứa </doc>, giống cách đọc theo dòng. Chỉ cần biết dòng đó bắt đầu
+        # trước hay sau mốc cap, nên không quét ngược cả dòng </doc> khi nó rất dài.
+        cap = body_start + limit
+        if end <= cap:
+            body_end = _rfind_line_break(mm, nl, end) + 1
+        elif _find_line_break(mm, cap, end) >= 0:
+            body_end = cap
+        else:
+            body_end = _rfind_line_break(mm, nl, cap) + 1
+        body_end = max(body_end, body_start)
+        title_in_tag = extract_title_from_opening_tag(mm[start:nl])
+        summary = _summary_from_bytes(view[body_start:body_end], summary_chars)
+        yield (title_in_tag, summary)
+        # phần còn lại của dòng </doc> không được quét tìm <doc
+        pos = _find_line_break(mm, end + 6, size)
+        if pos < 0:
+            break
+
+
+def _iter_doc_titles_cr(mm: mmap.mmap) -> Generator[Tuple[Optional[str], str], None, None]:
+    # Bản cho file có "\r" của _iter_doc_titles.
+    size = len(mm)
+    pos = 0
+    while True:
+        start = mm.find(b"<doc", pos)
+        if start < 0:
+            break
+        nl = _find_line_break(mm, start, size)
+        if nl < 0:
+            break
+        end = mm.find(b"</doc>", _after_line_break(mm, nl))
+        if end < 0:
+            break
+        yield (extract_title_from_opening_tag(mm[start:nl]), "")
+        pos = _find_line_break(mm, end + 6, size)
+        if pos < 0:
+            break
+
+
+def iter_doc_blocks(
+    file_path: Path, summary_chars: int
+) -> Generator[Tuple[Optional[str], str], None, None]:
+    with file_path.open("rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            yield from _iter_doc_blocks_stream(f, summary_chars)
+            return
+        # memoryview để giải mã thân doc trực tiếp từ vùng nhớ mmap, không copy ra bytes
+        with mm, memoryview(mm) as view:
+            if hasattr(mm, "madvise"):
+                # quét tuần tự một lượt: cho kernel đọc trước mạnh hơn
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            # Chọn vòng quét một lần ở đây thay vì rẽ nhánh cho từng doc. Chỉ file có "\r"
+            # mới cần xử lý xuống dòng kiểu universal newlines (chậm hơn).
+            has_cr = mm.find(b"\r") >= 0
+            if summary_chars > 0:
+                scan = _iter_doc_summaries_cr if has_cr else _iter_doc_summaries
+                yield from scan(mm, view, summary_chars)
+            else:
+                yield from (_iter_doc_titles_cr if has_cr else _iter_doc_titles)(mm)
 
 
 def collect_files(input_dirs: List[str], pattern: str, recursive: bool) -> List[Path]:
-    collected: List[Path] = []
+    # Duyệt bằng os.scandir để dùng lại thông tin loại file mà hệ điều hành trả về,
+    # không stat/resolve lại từng file.
+    collected = set()
     normalized_pattern = pattern or "*"
     for directory in input_dirs:
-        base = Path(directory)
-        if not base.exists() or not base.is_dir():
+        if not os.path.isdir(directory):
             continue
-        if recursive:
-            for root, _dirs, files in os.walk(base):
-                root_path = Path(root)
-                for name in files:
-                    if fnmatch.fnmatch(name, normalized_pattern):
-                        collected.append(root_path / name)
-        else:
-            for entry in base.iterdir():
-                if entry.is_file() and fnmatch.fnmatch(entry.name, normalized_pattern):
-                    collected.append(entry)
-    return sorted(set(p.resolve() for p in collected))
-
-
-def write_sharded_jsonl(
-    records: Iterable[dict],
-    output_dir: Path,
-    prefix: str,
-    max_records_per_file: int,
-) -> int:
-    output_dir.mkdir(parents=True, exist_ok=True)
-
-    shard_index = 1
-    record_in_shard = 0
-    file_handle = None
-    written_total = 0
-
-    def open_new_shard(idx: int):
-        filename = f"{prefix}_{idx:05d}.jsonl"
-        return (output_dir / filename).open("w", encoding="utf-8", errors="replace")
-
-    try:
-        file_handle = open_new_shard(shard_index)
-        for rec in records:
-            if max_records_per_file > 0 and record_in_shard >= max_records_per_file:
-                file_handle.close()
-                shard_index += 1
-                record_in_shard = 0
-                file_handle = open_new_shard(shard_index)
-
-            json_line = json.dumps(rec, ensure_ascii=False)
-            file_handle.write(json_line + "\n")
-            record_in_shard += 1
-            written_total += 1
-    finally:
-        if file_handle is not None and not file_handle.closed:
-            file_handle.close()
-
-    return written_total
+        pending = [directory]
+        while pending:
+            current = pending.pop()
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if recursive:
+                                pending.append(entry.path)
+                        elif entry.is_file() and fnmatch.fnmatch(entry.name, normalized_pattern):
+                            collected.add(entry.path)
+            except OSError:
+                # bỏ qua thư mục không đọc được, giống os.walk
+                continue
+    return [Path(p) for p in sorted(collected)]
 
 
 def generate_records_for_file(
     file_path: Path,
     summary_chars: int,
     title_max_chars: int,
-) -> Generator[dict, None, None]:
-    for title_in_tag, content in iter_doc_blocks(file_path):
-        raw_title = (title_in_tag or "").strip()
-        if not raw_title:
-            # fallback: dùng tên file khi thiếu title trong tag
-            raw_title = file_path.stem
-        title = raw_title[:title_max_chars] if title_max_chars > 0 else raw_title
-        summary = read_first_n_chars(content, summary_chars)
-        yield {"title": title, "summary": summary}
+) -> Generator[Tuple[str, str], None, None]:
+    # gán sẵn vào biến cục bộ để vòng lặp không phải tra cứu lại mỗi bản ghi
+    # fallback: dùng tên file khi thiếu title trong tag
+    fallback_title = file_path.stem
+    tmc = title_max_chars
+    blocks = iter_doc_blocks(file_path, summary_chars)
+    if tmc > 0:
+        # title fallback giống nhau cho cả file nên cắt sẵn một lần
+        fallback_sliced = fallback_title[:tmc]
+        for title_in_tag, summary in blocks:
+            title = title_in_tag.strip() if title_in_tag else ""
+            yield (title[:tmc] if title else fallback_sliced, summary)
+    else:
+        # không giới hạn độ dài title: bỏ hẳn bước cắt chuỗi
+        for title_in_tag, summary in blocks:
+            title = title_in_tag.strip() if title_in_tag else ""
+            yield (title or fallback_title, summary)
+
+
+def _process_files(tasks: List[Tuple[Path, int, int]]) -> List[bytes]:
+    # Chạy trong tiến trình con: trả về các dòng JSONL đã mã hóa của một nhóm file, theo thứ tự
+    lines: List[bytes] = []
+    for file_path, summary_chars, title_max_chars in tasks:
+        lines.extend(
+            encode_doc_record(title, summary)
+            for title, summary in generate_records_for_file(
+                file_path, summary_chars, title_max_chars
+            )
+        )
+    return lines
+
+
+def _iter_lines_parallel(
+    executor: ProcessPoolExecutor, tasks: List[Tuple[Path, int, int]], window: int
+) -> Iterator[bytes]:
+    # Mỗi lần submit gửi FILES_PER_TASK file để giảm số lượt trao đổi giữa các tiến trình.
+    # Chỉ giữ tối đa window nhóm đang xử lý/chờ ghi để bộ nhớ của tiến trình cha có giới hạn;
+    # lấy kết quả theo đúng thứ tự và nạp thêm nhóm mới mỗi khi một nhóm xong.
+    batches = (
+        tasks[i : i + FILES_PER_TASK] for i in range(0, len(tasks), FILES_PER_TASK)
+    )
+    # Nạp sẵn window đầu tiên ngay tại đây (không đợi generator chạy): lần submit đầu tiên
+    # tạo các tiến trình con, phải xảy ra trước khi write_sharded_jsonl bật thread ghi,
+    # vì fork từ tiến trình đã có nhiều thread không an toàn.
+    pending: Deque["Future[List[bytes]]"] = deque(
+        executor.submit(_process_files, batch) for batch in islice(batches, window)
+    )
+
+    def drain() -> Iterator[bytes]:
+        while pending:
+            batch_lines = pending.popleft().result()
+            next_batch = next(batches, None)
+            if next_batch is not None:
+                pending.append(executor.submit(_process_files, next_batch))
+            yield from batch_lines
+
+    return drain()
 
 
 def main() -> None:
     args = parse_args()
 
     if args.input_file:
-        files = [Path(args.input_file)]
+        input_file = Path(args.input_file)
+        # không dùng is_file() để vẫn nhận pipe/FIFO; chỉ loại đường dẫn không tồn tại và thư mục
+        files = [input_file] if input_file.exists() and not input_file.is_dir() else []
     else:
         files = collect_files(args.input_dirs, args.glob_pattern, recursive=not args.no_subdirs)
 
-    files = [p for p in files if p.exists() and p.is_file()]
     if not files:
         raise FileNotFoundError("Không tìm thấy file đầu vào hợp lệ.")
 
     if args.dry_run:
         # In thử 2 record đầu từ file đầu tiên
         first = files[0]
-        for i, rec in enumerate(
+        for i, (title, summary) in enumerate(
             generate_records_for_file(first, args.summary_chars, args.title_max_chars)
         ):
-            print(json.dumps(rec, ensure_ascii=False))
+            print(json.dumps({"title": title, "summary": summary}, ensure_ascii=False))
             if i >= 1:
                 break
         return
 
-    total = write_sharded_jsonl(
-        (
-            rec
-            for f in files
-            for rec in generate_records_for_file(f, args.summary_chars, args.title_max_chars)
-        ),
-        output_dir=Path(args.output_dir),
-        prefix=args.prefix,
-        max_records_per_file=args.max_records_per_file,
-    )
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    output_dir = Path(args.output_dir)
+    if workers == 1 or len(files) == 1:
+        total = write_sharded_jsonl(
+            (
+                encode_doc_record(title, summary)
+                for f in files
+                for title, summary in generate_records_for_file(
+                    f, args.summary_chars, args.title_max_chars
+                )
+            ),
+            output_dir=output_dir,
+            prefix=args.prefix,
+            max_records_per_file=args.max_records_per_file,
+        )
+    else:
+        # Các file được phân tích song song, ghi shard theo đúng thứ tự file
+        tasks = [(f, args.summary_chars, args.title_max_chars) for f in files]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            total = write_sharded_jsonl(
+                _iter_lines_parallel(executor, tasks, window=workers * 2),
+                output_dir=output_dir,
+                prefix=args.prefix,
+                max_records_per_file=args.max_records_per_file,
+            )
 
     print(f"Đã ghi {total} doc vào thư mục '{args.output_dir}'. Tiền tố: '{args.prefix}'.")
 